@@ -304,7 +304,6 @@ def _get_edge_edges_and_index(edge_index, symmetric_edges=False):
         distinct_edges = sorted(set(map(tuple,
                                         torch.sort(edge_index.transpose(1, 0),
                                                    dim=-1)[0].numpy().tolist())))
-        print(distinct_edges)
         edge_index_dict = collections.OrderedDict(zip(distinct_edges, range(len(distinct_edges))))
         edge_edge_index = [
             [edge_index_dict[tuple(sorted(edge1))], edge_index_dict[tuple(sorted(edge2))]]
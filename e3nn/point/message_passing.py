@@ -1,19 +1,114 @@
 # pylint: disable=arguments-differ, redefined-builtin, missing-docstring, no-member, invalid-name, line-too-long, not-callable, abstract-method
+import contextlib
 import math
 import torch
 import torch_geometric as tg
+from torch_scatter import segment_csr
 
 from e3nn import rsh, rs
 from e3nn.tensor_product import WeightedTensorProduct, GroupedWeightedTensorProduct
 from e3nn.linear import Linear
 
 
+def autocast(device, dtype):
+    """
+    autocast context to dtype, does nothing if dtype is None
+
+    torch.autocast requires torch >= 1.10
+    """
+    if dtype is None:
+        return contextlib.nullcontext()
+    if not hasattr(torch, 'autocast'):
+        raise RuntimeError("autocast to {} requires torch >= 1.10, found torch {}".format(dtype, torch.__version__))
+    return torch.autocast(device.type, dtype=dtype)
+
+
+_side_streams = {}
+
+
+def side_stream(device):
+    """
+    a CUDA stream, other than the default one, reused for each device
+    """
+    if device not in _side_streams:
+        _side_streams[device] = torch.cuda.Stream(device)
+    return _side_streams[device]
+
+
+def csr_ptr(edge_index, dim_size):
+    """
+    sort the messages by source
+
+    It only depends on `edge_index`, it can be computed once and shared by all the layers
+
+    :param edge_index: LongTensor of shape [2, num_messages]
+    :param dim_size: n_source
+
+    :return: (perm, crow) such that `edge_index[:, perm]` is sorted by source
+             and the messages of source `i` are `perm[crow[i]:crow[i + 1]]`
+    """
+    src = edge_index[0]
+    perm = src.argsort()  # the order of the messages of a source does not matter for a sum
+    # crow[i] = number of messages whose source is < i, searchsorted does not need a device to host sync (unlike bincount)
+    crow = torch.searchsorted(src[perm], torch.arange(dim_size + 1, device=src.device))
+    return perm, crow
+
+
+def wtp_message_aggregate(message, features, edge_index, sh, w, dim_size, dim_out, chunk_size=None, csr=None, autocast_dtype=None):
+    """
+    gather the neighbors, compute their messages and sum them into the sources
+
+    When `chunk_size` is given, the edges are processed by chunks. Under `torch.no_grad()` at most
+    `[chunk_size, dim(Rs_in)]` gathered features and `[chunk_size, dim(Rs_out)]` messages are alive at once.
+    With autograd the inputs of every chunk are kept for the backward, so the peak memory of training is not reduced.
+    With `chunk_size=None` the gathered features and the messages of all the edges are materialized.
+
+    :param message: called on each chunk as `message(x_j, sh, w)`, returns Tensor of shape [chunk, dim_out]
+    :param features: Tensor of shape [n_target, dim(Rs_in)]
+    :param edge_index: LongTensor of shape [2, num_messages]
+    :param sh: Tensor of shape [num_messages, dim(Rs_sh)]
+    :param w: Tensor of shape [num_messages, nweight]
+    :param dim_size: n_source
+    :param dim_out: dimension of the messages
+    :param chunk_size: number of edges processed at once, None to process all of them together
+    :param csr: optional (perm, crow) given by `csr_ptr`, used to sum the messages with `segment_csr` when `chunk_size` is None
+    :param autocast_dtype: if not None, the messages are evaluated under autocast to this dtype, requires torch >= 1.10
+
+    :return: Tensor of shape [n_source, dim_out]
+    """
+    if chunk_size is None and csr is not None:
+        # sort the edges by source, their messages are then contiguous segments
+        perm, crow = csr
+        x_j = features.index_select(0, edge_index[1, perm])  # [num_messages, dim(Rs_in)]
+        with autocast(features.device, autocast_dtype):
+            messages = message(x_j, sh[perm], w[perm])
+        return segment_csr(messages.to(features.dtype), crow, reduce='sum')
+
+    num_messages = edge_index.shape[1]
+    if chunk_size is None:
+        chunk_size = max(num_messages, 1)
+
+    out = features.new_zeros(dim_size, dim_out)
+    for begin in range(0, num_messages, chunk_size):
+        s = slice(begin, begin + chunk_size)
+        x_j = features.index_select(0, edge_index[1, s])  # [chunk, dim(Rs_in)]
+        with autocast(features.device, autocast_dtype):
+            messages = message(x_j, sh[s], w[s])
+        out.index_add_(0, edge_index[0, s], messages.to(out.dtype))
+    return out
+
+
 class Convolution(tg.nn.MessagePassing):
-    def __init__(self, kernel):
+    def __init__(self, kernel, autocast_dtype=None):
+        """
+        :param kernel: kernel module, called on edge_r
+        :param autocast_dtype: if not None, the kernel and the messages are evaluated under autocast to this dtype (e.g. torch.bfloat16), requires torch >= 1.10
+        """
         super(Convolution, self).__init__(aggr='add', flow='target_to_source')
         self.kernel = kernel
+        self.autocast_dtype = autocast_dtype
 
-    def forward(self, features, edge_index, edge_r, size=None, n_norm=1, groups=1):
+    def forward(self, features, edge_index, edge_r, size=None, n_norm=1, groups=1, csr=None):
         """
         :param features: Tensor of shape [n_target, dim(Rs_in)]
         :param edge_index: LongTensor of shape [2, num_messages]
@@ -23,12 +118,30 @@ class Convolution(tg.nn.MessagePassing):
                        edge_r = position_target - position_source
         :param size: (n_target, n_source) or None
         :param n_norm: typical number of targets per source
+        :param csr: optional (perm, crow) given by `csr_ptr`, to compute the messages sorted by source and sum them with `segment_csr`
+                    instead of scattering them with `index_add_`
 
         :return: Tensor of shape [n_source, dim(Rs_out)]
         """
-        k = self.kernel(edge_r)
-        k.div_(n_norm ** 0.5)
-        return self.propagate(edge_index, size=size, x=features, k=k, groups=groups)
+        n_source = size[1] if size is not None else features.shape[0]
+
+        if csr is not None:
+            # sort the edges by source, their messages are then contiguous segments
+            perm, crow = csr
+            edge_r = edge_r[perm]
+            target = edge_index[1, perm]
+        else:
+            target = edge_index[1]
+
+        with autocast(edge_r.device, self.autocast_dtype):
+            k = self.kernel(edge_r)
+            k.div_(n_norm ** 0.5)
+            messages = self.message(features.index_select(0, target), k, groups)  # [num_messages, groups * dim(Rs_out)]
+        messages = messages.to(features.dtype)
+
+        if csr is not None:
+            return segment_csr(messages, crow, reduce='sum')
+        return messages.new_zeros(n_source, messages.shape[1]).index_add_(0, edge_index[0], messages)
 
     def message(self, x_j, k, groups):
         N = x_j.shape[0]
@@ -37,17 +150,22 @@ class Convolution(tg.nn.MessagePassing):
         if k.shape[0] == 0:  # https://github.com/pytorch/pytorch/issues/37628
             return torch.zeros(0, groups * cout)
         if k.dim() == 4 and k.shape[1] == groups:  # kernel has group dimension
-            return torch.einsum('egij,egj->egi', k, x_j).reshape(N, groups * cout)
-        return torch.einsum('eij,egj->egi', k, x_j).reshape(N, groups * cout)
+            # [N * groups, cout, cin] @ [N * groups, cin, 1]
+            return torch.bmm(k.reshape(N * groups, cout, cin), x_j.reshape(N * groups, cin, 1)).reshape(N, groups * cout)
+        # [N, cout, cin] @ [N, cin, groups]
+        return torch.bmm(k, x_j.transpose(1, 2)).transpose(1, 2).reshape(N, groups * cout)
 
 
 class WTPConv(tg.nn.MessagePassing):
-    def __init__(self, Rs_in, Rs_out, Rs_sh, RadialModel, normalization='component'):
+    def __init__(self, Rs_in, Rs_out, Rs_sh, RadialModel, normalization='component', chunk_size=None, radial_dtype=None, autocast_dtype=None):
         """
         :param Rs_in:  input representation
         :param lmax:   spherical harmonic representation
         :param Rs_out: output representation
         :param RadialModel: model constructor
+        :param chunk_size: number of edges processed at once (see `wtp_message_aggregate`)
+        :param radial_dtype: if not None, the radial model is evaluated under autocast to this dtype (e.g. torch.bfloat16), requires torch >= 1.10
+        :param autocast_dtype: if not None, the tensor product is evaluated under autocast to this dtype (e.g. torch.bfloat16), requires torch >= 1.10
         """
         super().__init__(aggr='add', flow='target_to_source')
         self.Rs_in = rs.simplify(Rs_in)
@@ -57,8 +175,11 @@ class WTPConv(tg.nn.MessagePassing):
         self.rm = RadialModel(self.tp.nweight)
         self.Rs_sh = Rs_sh
         self.normalization = normalization
+        self.chunk_size = chunk_size
+        self.radial_dtype = radial_dtype
+        self.autocast_dtype = autocast_dtype
 
-    def forward(self, features, edge_index, edge_r, sh=None, size=None, n_norm=1):
+    def forward(self, features, edge_index, edge_r, sh=None, size=None, n_norm=1, r_norm=None, csr=None):
         """
         :param features: Tensor of shape [n_target, dim(Rs_in)]
         :param edge_index: LongTensor of shape [2, num_messages]
@@ -69,6 +190,10 @@ class WTPConv(tg.nn.MessagePassing):
         :param sh: Tensor of shape [num_messages, dim(Rs_sh)]
         :param size: (n_target, n_source) or None
         :param n_norm: typical number of targets per source
+        :param r_norm: Tensor of shape [num_messages], edge_r.norm(dim=1)
+        :param csr: optional (perm, crow) given by `csr_ptr`, used to sum the messages when `chunk_size` is None
+
+        sh, r_norm and csr only depend on the edges, they can be computed once and shared by all the layers
 
         :return: Tensor of shape [n_source, dim(Rs_out)]
         """
@@ -76,9 +201,14 @@ class WTPConv(tg.nn.MessagePassing):
             sh = rsh.spherical_harmonics_xyz(self.Rs_sh, edge_r, self.normalization)  # [num_messages, dim(Rs_sh)]
         sh = sh / n_norm**0.5
 
-        w = self.rm(edge_r.norm(dim=1))  # [num_messages, nweight]
+        if r_norm is None:
+            r_norm = edge_r.norm(dim=1)  # [num_messages]
+        with autocast(r_norm.device, self.radial_dtype):
+            w = self.rm(r_norm)  # [num_messages, nweight]
+        w = w.to(sh.dtype)
 
-        return self.propagate(edge_index, size=size, x=features, sh=sh, w=w)
+        n_source = size[1] if size is not None else features.shape[0]
+        return wtp_message_aggregate(self.message, features, edge_index, sh, w, n_source, rs.dim(self.Rs_out), self.chunk_size, csr, self.autocast_dtype)
 
     def message(self, x_j, sh, w):
         """
@@ -95,7 +225,7 @@ class WTPConv2(tg.nn.MessagePassing):
 
     This class assumes that the input and output atom positions are the same
     """
-    def __init__(self, Rs_in, Rs_out, Rs_sh, RadialModel, groups=math.inf, normalization='component'):
+    def __init__(self, Rs_in, Rs_out, Rs_sh, RadialModel, groups=math.inf, normalization='component', chunk_size=None, radial_dtype=None, autocast_dtype=None):
         super().__init__(aggr='add', flow='target_to_source')
         self.Rs_in = rs.simplify(Rs_in)
         self.Rs_out = rs.simplify(Rs_out)
@@ -106,23 +236,61 @@ class WTPConv2(tg.nn.MessagePassing):
         self.lin2 = Linear(Rs_out, Rs_out)
         self.Rs_sh = Rs_sh
         self.normalization = normalization
+        self.chunk_size = chunk_size
+        self.radial_dtype = radial_dtype
+        self.autocast_dtype = autocast_dtype
+
+        has_self_interaction = torch.cat([
+            torch.full((mul * (2 * l + 1),), any(l_in == l and p_in == p for _, l_in, p_in in self.Rs_in), dtype=torch.bool)
+            for mul, l, p in self.Rs_out
+        ])
+        self.register_buffer('has_self_interaction', has_self_interaction, persistent=False)  # [dim(Rs_out)]
+
+    def forward(self, features, edge_index, edge_r, sh=None, size=None, n_norm=1, r_norm=None, csr=None):
+        """
+        :param features: Tensor of shape [num_atoms, dim(Rs_in)]
+        :param edge_index: LongTensor of shape [2, num_messages]
+        :param edge_r: Tensor of shape [num_messages, 3]
+        :param sh: Tensor of shape [num_messages, dim(Rs_sh)]
+        :param size: (num_atoms, num_atoms) or None
+        :param n_norm: typical number of targets per source
+        :param r_norm: Tensor of shape [num_messages], edge_r.norm(dim=1)
+        :param csr: optional (perm, crow) given by `csr_ptr`, used to sum the messages when `chunk_size` is None
+
+        sh, r_norm and csr only depend on the edges, they can be computed once and shared by all the layers
+
+        :return: Tensor of shape [num_atoms, dim(Rs_out)]
+        """
+        if features.is_cuda:
+            # lin1 does not depend on the edges, overlap it with sh and rm
+            stream = side_stream(features.device)
+            stream.wait_stream(torch.cuda.current_stream(features.device))
+            with torch.cuda.stream(stream), autocast(features.device, self.autocast_dtype):
+                self_interation = self.lin1(features)
+        else:
+            with autocast(features.device, self.autocast_dtype):
+                self_interation = self.lin1(features)
 
-    def forward(self, features, edge_index, edge_r, sh=None, size=None, n_norm=1):
-        # features = [num_atoms, dim(Rs_in)]
         if sh is None:
             sh = rsh.spherical_harmonics_xyz(self.Rs_sh, edge_r, self.normalization)  # [num_messages, dim(Rs_sh)]
         sh = sh / n_norm**0.5
 
-        w = self.rm(edge_r.norm(dim=1))  # [num_messages, nweight]
+        if r_norm is None:
+            r_norm = edge_r.norm(dim=1)  # [num_messages]
+        with autocast(r_norm.device, self.radial_dtype):
+            w = self.rm(r_norm)  # [num_messages, nweight]
+        w = w.to(sh.dtype)
 
-        self_interation = self.lin1(features)
-        features = self.propagate(edge_index, size=size, x=features, sh=sh, w=w)
-        features = self.lin2(features)
-        has_self_interaction = torch.cat([
-            features.new_ones(mul * (2 * l + 1)) if any(l_in == l and p_in == p for _, l_in, p_in in self.Rs_in) else features.new_zeros(mul * (2 * l + 1))
-            for mul, l, p in self.Rs_out
-        ])
-        return 0.5**0.5 * self_interation + (1 + (0.5**0.5 - 1) * has_self_interaction) * features
+        if features.is_cuda:
+            torch.cuda.current_stream(features.device).wait_stream(stream)
+            self_interation.record_stream(torch.cuda.current_stream(features.device))
+
+        n_source = size[1] if size is not None else features.shape[0]
+        out = wtp_message_aggregate(self.message, features, edge_index, sh, w, n_source, rs.dim(self.Rs_out), self.chunk_size, csr, self.autocast_dtype)
+        with autocast(features.device, self.autocast_dtype):
+            out = self.lin2(out)
+        si_scale = 1 + (0.5**0.5 - 1) * self.has_self_interaction.to(features.dtype)
+        return 0.5**0.5 * self_interation.to(features.dtype) + si_scale * out.to(features.dtype)
 
     def message(self, x_j, sh, w):
         return self.tp(x_j, sh, w)
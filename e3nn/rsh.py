@@ -232,12 +232,71 @@ def spherical_harmonics_alpha_z_y(Rs, alpha, z, y):
     return out.reshape(alpha.shape + (shz.shape[1],))
 
 
+_spherical_harmonics_xyz_code = """
+import torch
+
+@torch.jit.script
+def main(x: torch.Tensor, y: torch.Tensor, z: torch.Tensor) -> torch.Tensor:
+    out = x.new_empty(x.shape + (lsize,))
+    c0 = torch.ones_like(x)
+    s0 = torch.zeros_like(x)
+
+# fill out
+
+    return out
+"""
+
+
 @lru_cache()
 def _rep_zx(Rs, dtype, device):
     o = torch.zeros((), dtype=dtype, device=device)
     return rs.rep(Rs, o, -math.pi / 2, o)
 
 
+@lru_cache()
+def _spherical_harmonics_xyz_genjit(ls):
+    """
+    closed form polynomials in x, y, z of the spherical harmonics of a unit vector
+
+    sin(beta)^m cos(m alpha) and sin(beta)^m sin(m alpha) are the real and imaginary parts of (x + iy)^m,
+    the remaining factor of the associated Legendre polynomial is a polynomial in z
+
+    The monomials in z lose precision as l grows, only used for small l
+    """
+    ls = list(ls)
+    z, y = symbols('z y', real=True)
+    fill = ""
+
+    # c{m} + i s{m} = (x + iy)^m
+    for m in range(1, max(ls) + 1):
+        fill += "    c{0} = c{1} * x - s{1} * y\n".format(m, m - 1)
+        fill += "    s{0} = s{1} * x + c{1} * y\n".format(m, m - 1)
+    fill += "\n"
+
+    for l in sorted(set(ls)):
+        for m in range(l + 1):
+            p = Poly(sympy_legendre(l, m) / y**m, domain='R', gens=(z,)).as_dict()
+            formula = " + ".join("{:.25f} * z**{}".format(c, zn) for (zn,), c in p.items())
+            fill += "    p{}_{} = {}\n".format(l, m, formula)
+    fill += "\n"
+
+    i = 0
+    for l in ls:
+        for m in range(-l, l + 1):
+            if m < 0:
+                fill += "    out[..., {}] = {} * p{}_{} * s{}\n".format(i, math.sqrt(2), l, -m, -m)
+            if m == 0:
+                fill += "    out[..., {}] = p{}_0 * c0\n".format(i, l)
+            if m > 0:
+                fill += "    out[..., {}] = {} * p{}_{} * c{}\n".format(i, math.sqrt(2), l, m, m)
+            i += 1
+
+    code = _spherical_harmonics_xyz_code
+    code = code.replace("lsize", str(sum(2 * l + 1 for l in ls)))
+    code = code.replace("# fill out", fill)
+    return eval_code(code).main
+
+
 def spherical_harmonics_xyz(Rs, xyz, normalization='none'):
     """
     spherical harmonics
@@ -261,6 +320,11 @@ def spherical_harmonics_xyz(Rs, xyz, normalization='none'):
         except ImportError:
             pass
 
+    if sh is None and rs.lmax(Rs) <= 6:
+        assert all(p in [0, (-1)**l] for _, l, p in Rs)
+        ls = [l for mul, l, _ in Rs for _ in range(mul)]
+        sh = _spherical_harmonics_xyz_genjit(tuple(ls))(xyz[:, 0], xyz[:, 1], xyz[:, 2])
+
     if sh is None:
         # if z > x, rotate x-axis with z-axis
         s = xyz[:, 2].abs() > xyz[:, 0].abs()
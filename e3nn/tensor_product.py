@@ -297,6 +297,21 @@ class CustomWeightedTensorProduct(torch.nn.Module):
                         count[pos] += mul_1 * mul_2
                     continue
 
+                if mode == 'uvw':
+                    # contract C with x2 first, then x1 and the weights as batched matrix products
+                    wigners.add((l_1, l_2, l_out))
+                    code += f"    s2 = ein('zvj,ijk->zivk', s2, C{l_1}_{l_2}_{l_out}).reshape(batch, {2 * l_1 + 1}, {mul_2 * (2 * l_out + 1)})\n"
+                    code += f"    s12 = torch.bmm(s1, s2).reshape(batch, {mul_1 * mul_2}, {2 * l_out + 1})\n"
+                    dim_w = mul_1 * mul_2 * mul_out
+                    code += f"    sw = w[:, {index_w}:{index_w+dim_w}].reshape(batch, {mul_1 * mul_2}, {mul_out})\n"
+                    index_w += dim_w
+                    code += f"    out[:, {index_out}:{index_out+dim_out}] += torch.bmm(sw.transpose(1, 2), s12).reshape(batch, {dim_out})\n"
+                    code += "\n"
+
+                    for pos in range(index_out, index_out + dim_out):
+                        count[pos] += mul_1 * mul_2
+                    continue
+
             if last_ss != (i_1, i_2, mode[:2]):
                 if mode[:2] == 'uv':
                     code += f"    ss = ein('zui,zvj->zuvij', s1, s2)\n"
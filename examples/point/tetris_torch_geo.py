@@ -10,7 +10,7 @@ from e3nn.point.data_helpers import DataNeighbors
 from e3nn import o3, rsh
 from e3nn.networks import MLNetwork, make_gated_block
 from e3nn.non_linearities.rescaled_act import swish
-from e3nn.point.message_passing import WTPConv2
+from e3nn.point.message_passing import WTPConv2, csr_ptr
 from e3nn.radial import GaussianRadialModel
 
 
@@ -46,9 +46,11 @@ def forward(f, shapes, Rs_sh, device):
     x = torch.ones(4, 1)
     batch = Batch.from_data_list([DataNeighbors(x, shape, r_max, self_interaction=False) for shape in shapes])
     batch = batch.to(device)
-    # Pre-compute the spherical harmonics and re-use them in each convolution
+    # Pre-compute the spherical harmonics, the distances and the edges sorted by source and re-use them in each convolution
     sh = rsh.spherical_harmonics_xyz(Rs_sh, batch.edge_attr, 'component')
-    out = f(batch.x, batch.edge_index, batch.edge_attr, sh=sh, n_norm=3)
+    r_norm = batch.edge_attr.norm(dim=1)
+    csr = csr_ptr(batch.edge_index, batch.num_nodes)
+    out = f(batch.x, batch.edge_index, batch.edge_attr, sh=sh, n_norm=3, r_norm=r_norm, csr=csr)
     out = scatter_add(out, batch.batch, dim=0)
     out = torch.tanh(out)
     return out
@@ -35,7 +35,7 @@ KWARGS = dict(
         'lie_learn',
         'scipy',
         'sympy',
-        'torch>=1.4.0',
+        'torch>=1.6.0',
         'torch_scatter',
         'torch_sparse',
         'torch_cluster',
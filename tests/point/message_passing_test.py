@@ -4,11 +4,13 @@ from functools import partial
 
 import pytest
 import torch
+from torch_scatter import scatter_add
 
-from e3nn import o3, rs
+from e3nn import o3, rs, rsh
 from e3nn.kernel import Kernel, GroupKernel
-from e3nn.point.message_passing import Convolution, WTPConv
-from e3nn.radial import ConstantRadialModel
+from e3nn.non_linearities.rescaled_act import swish
+from e3nn.point.message_passing import Convolution, WTPConv, WTPConv2, csr_ptr
+from e3nn.radial import ConstantRadialModel, GaussianRadialModel
 
 
 @pytest.mark.parametrize('Rs_in, Rs_out, n_source, n_target, n_edge', itertools.product([[1]], [[2]], [2, 3], [1, 3], [0, 3]))
@@ -80,6 +82,57 @@ def test_equivariance_wtp(Rs_in, Rs_out, n_source, n_target, n_edge):
     assert (out1 - out2).abs().max() < 1e-10
 
 
+def _random_graph(Rs_in, n=5, n_edge=10):
+    """
+    features, edge_index and edge_r of a random graph of n nodes
+    """
+    features = rs.randn(n, Rs_in)
+    edge_index = torch.randint(n, size=(2, n_edge))
+    edge_r = torch.randn(n_edge, 3)
+    return features, edge_index, edge_r
+
+
+def test_equivariance_wtp2():
+    torch.set_default_dtype(torch.float64)
+
+    Rs_in, Rs_out = [(2, 0), (1, 1)], [(1, 0), (2, 1), (1, 2)]
+    mp = WTPConv2(Rs_in, Rs_out, 2, ConstantRadialModel)
+
+    features, edge_index, edge_r = _random_graph(Rs_in)
+
+    out1 = mp(features, edge_index, edge_r)
+
+    angles = o3.rand_angles()
+    D_in = rs.rep(Rs_in, *angles)
+    D_out = rs.rep(Rs_out, *angles)
+    R = o3.rot(*angles)
+
+    out2 = mp(features @ D_in.T, edge_index, edge_r @ R.T) @ D_out
+
+    assert (out1 - out2).abs().max() < 1e-10
+
+
+def test_wtp2_self_interaction():
+    torch.set_default_dtype(torch.float64)
+
+    Rs_in, Rs_out = [(2, 0), (1, 1)], [(1, 0), (2, 1), (1, 2)]
+    mp = WTPConv2(Rs_in, Rs_out, 2, ConstantRadialModel)
+
+    features, edge_index, edge_r = _random_graph(Rs_in)
+
+    sh = rsh.spherical_harmonics_xyz(mp.Rs_sh, edge_r, mp.normalization)
+    w = mp.rm(edge_r.norm(dim=1))
+    messages = mp.tp(features[edge_index[1]], sh, w)
+    features_out = torch.zeros(len(features), rs.dim(Rs_out)).index_add_(0, edge_index[0], messages)
+    has_self_interaction = torch.cat([
+        torch.ones(mul * (2 * l + 1)) if any(l_in == l and p_in == p for _, l_in, p_in in mp.Rs_in) else torch.zeros(mul * (2 * l + 1))
+        for mul, l, p in mp.Rs_out
+    ])
+    out = 0.5**0.5 * mp.lin1(features) + (1 + (0.5**0.5 - 1) * has_self_interaction) * mp.lin2(features_out)
+
+    assert (mp(features, edge_index, edge_r) - out).abs().max() < 1e-10
+
+
 def test_flow():
     """
     This test checks that information is flowing as expected from target to source.
@@ -111,3 +164,102 @@ def test_flow():
     output = conv(features, edge_index, edge_r)
     torch.allclose(output, torch.tensor(
         [0., -1., -1., -1., -1.]).unsqueeze(-1))
+
+
+@pytest.mark.parametrize('Conv', [WTPConv, WTPConv2])
+def test_r_norm(Conv):
+    torch.set_default_dtype(torch.float64)
+
+    Rs_in, Rs_out = [(2, 0), (1, 1)], [(1, 0), (2, 1)]
+    mp = Conv(Rs_in, Rs_out, 2, partial(GaussianRadialModel, max_radius=3.0, number_of_basis=3, h=100, L=1, act=swish))
+
+    features, edge_index, edge_r = _random_graph(Rs_in)
+
+    assert (mp(features, edge_index, edge_r) - mp(features, edge_index, edge_r, r_norm=edge_r.norm(dim=1))).abs().max() < 1e-10
+
+
+def _convolution(Rs_in, Rs_out, RadialModel, **kwargs):
+    return Convolution(Kernel(Rs_in, Rs_out, RadialModel), **kwargs)
+
+
+@pytest.mark.skipif(not hasattr(torch, 'autocast'), reason='torch >= 1.10')
+@pytest.mark.parametrize('Conv, option', [
+    (partial(WTPConv, Rs_sh=2), 'radial_dtype'),
+    (partial(WTPConv2, Rs_sh=2), 'radial_dtype'),
+    (_convolution, 'autocast_dtype'),
+    (partial(WTPConv, Rs_sh=2), 'autocast_dtype'),
+    (partial(WTPConv2, Rs_sh=2), 'autocast_dtype'),
+])
+def test_bfloat16(Conv, option):
+    torch.set_default_dtype(torch.float32)
+
+    Rs_in, Rs_out = [(2, 0), (1, 1)], [(1, 0), (2, 1)]
+    RadialModel = partial(GaussianRadialModel, max_radius=3.0, number_of_basis=3, h=100, L=1, act=swish)
+    mp = Conv(Rs_in, Rs_out, RadialModel=RadialModel)
+    mp_bf16 = Conv(Rs_in, Rs_out, RadialModel=RadialModel, **{option: torch.bfloat16})
+    mp_bf16.load_state_dict(mp.state_dict())
+
+    features, edge_index, edge_r = _random_graph(Rs_in)
+
+    out = mp(features, edge_index, edge_r)
+    out_bf16 = mp_bf16(features, edge_index, edge_r)
+
+    assert out_bf16.dtype == torch.float32
+    assert (out - out_bf16).abs().max() < 5e-2 * out.abs().max()
+
+
+def _scatter_reference(mp, features, edge_index, edge_r, n_source):
+    """
+    scatter_add of the per-edge messages
+    """
+    if isinstance(mp, Convolution):
+        messages = torch.einsum('eij,ej->ei', mp.kernel(edge_r), features[edge_index[1]])
+        return scatter_add(messages, edge_index[0], dim=0, dim_size=n_source)
+
+    sh = rsh.spherical_harmonics_xyz(mp.Rs_sh, edge_r, mp.normalization)
+    messages = mp.tp(features[edge_index[1]], sh, mp.rm(edge_r.norm(dim=1)))
+    out = scatter_add(messages, edge_index[0], dim=0, dim_size=n_source)
+    if isinstance(mp, WTPConv2):
+        out = 0.5**0.5 * mp.lin1(features) + (1 + (0.5**0.5 - 1) * mp.has_self_interaction.to(out.dtype)) * mp.lin2(out)
+    return out
+
+
+@pytest.mark.parametrize('Conv, kwargs, use_csr', [
+    (_convolution, dict(), False),
+    (_convolution, dict(), True),
+    (partial(WTPConv, Rs_sh=2), dict(), False),
+    (partial(WTPConv, Rs_sh=2), dict(chunk_size=3), False),
+    (partial(WTPConv, Rs_sh=2), dict(), True),
+    (partial(WTPConv2, Rs_sh=2), dict(), False),
+    (partial(WTPConv2, Rs_sh=2), dict(chunk_size=3), False),
+    (partial(WTPConv2, Rs_sh=2), dict(), True),
+])
+def test_aggregation(Conv, kwargs, use_csr):
+    torch.set_default_dtype(torch.float64)
+
+    Rs_in, Rs_out = [(2, 0), (1, 1)], [(1, 0), (2, 1)]
+    mp = Conv(Rs_in, Rs_out, RadialModel=ConstantRadialModel, **kwargs)
+
+    n = 5
+    features, edge_index, edge_r = _random_graph(Rs_in, n, n_edge=20)
+    csr = csr_ptr(edge_index, n) if use_csr else None
+
+    assert (mp(features, edge_index, edge_r, csr=csr) - _scatter_reference(mp, features, edge_index, edge_r, n)).abs().max() < 1e-10
+
+
+@pytest.mark.parametrize('chunk_size', [None, 3])
+def test_wtp_message_override(chunk_size):
+    torch.set_default_dtype(torch.float64)
+
+    class DoubleWTPConv(WTPConv):
+        def message(self, x_j, sh, w):
+            return 2 * super().message(x_j, sh, w)
+
+    Rs_in, Rs_out = [(2, 0), (1, 1)], [(1, 0), (2, 1)]
+    mp = WTPConv(Rs_in, Rs_out, 2, ConstantRadialModel, chunk_size=chunk_size)
+    mp_double = DoubleWTPConv(Rs_in, Rs_out, 2, ConstantRadialModel, chunk_size=chunk_size)
+    mp_double.load_state_dict(mp.state_dict())
+
+    features, edge_index, edge_r = _random_graph(Rs_in)
+
+    assert (2 * mp(features, edge_index, edge_r) - mp_double(features, edge_index, edge_r)).abs().max() < 1e-10
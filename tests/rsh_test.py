@@ -2,6 +2,7 @@
 import math
 from functools import partial
 
+import pytest
 import torch
 from e3nn import o3, rsh
 
@@ -25,6 +26,22 @@ def test_sh_is_in_irrep():
             assert (Y - D[:, l]).norm() < 1e-10
 
 
+@pytest.mark.parametrize('dtype, ls, tol', [
+    (torch.float64, [0, 1, 2, 3, 4, 5, 6], 1e-10),
+    (torch.float64, [10, 15], 1e-9),
+    (torch.float32, [0, 1, 2, 3, 4, 5, 6], 1e-4),
+    (torch.float32, [10, 15], 1e-3),
+])
+def test_sh_xyz_alpha_beta(dtype, ls, tol):
+    with o3.torch_default_dtype(torch.float64):
+        alpha, beta = 2 * math.pi * torch.rand(100), math.pi * torch.rand(100)
+        x = torch.stack([beta.sin() * alpha.cos(), beta.sin() * alpha.sin(), beta.cos()], dim=-1)
+        Y2 = rsh.spherical_harmonics_alpha_beta(ls, alpha, beta)
+    with o3.torch_default_dtype(dtype):
+        Y1 = rsh.spherical_harmonics_xyz(ls, x.to(dtype))
+    assert (Y1.double() - Y2).abs().max() < tol
+
+
 def test_sh_cuda_single():
     if torch.cuda.is_available():
         with o3.torch_default_dtype(torch.float64):